@@ -0,0 +1,22 @@
+"""Test configuration for the Mi Kettle component."""
+import sys
+import types
+
+try:
+    import bluepy.btle  # noqa: F401
+except ImportError:
+    # bluepy needs BlueZ to build; the protocol helpers under test only need
+    # the names mikettle.py imports from it
+    btle = types.ModuleType("bluepy.btle")
+
+    class _Unavailable(object):
+        def __init__(self, *args, **kwargs):
+            raise RuntimeError("bluepy is not installed")
+
+    btle.UUID = _Unavailable
+    btle.Peripheral = _Unavailable
+    btle.DefaultDelegate = object
+    bluepy = types.ModuleType("bluepy")
+    bluepy.btle = btle
+    sys.modules["bluepy"] = bluepy
+    sys.modules["bluepy.btle"] = btle
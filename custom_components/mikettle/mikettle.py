@@ -3,9 +3,17 @@ Read data from Mi Kettle.
 """
 
 import logging
+import struct
 from bluepy.btle import UUID, Peripheral, DefaultDelegate
-from datetime import datetime, timedelta
-from threading import Lock
+from threading import Condition, Lock, local
+import time
+
+try:
+    import numpy as np
+    from numba import njit
+    _USE_NUMBA = True
+except ImportError:
+    _USE_NUMBA = False
 
 _SESSION_START = bytes([0x00, 0xBC, 0x43, 0xCD])
 _SESSION_END = bytes([0x09, 0xAC, 0xBF, 0x93])
@@ -26,6 +34,11 @@ _UUID_SERVICE_KETTLE_DATA = "01344736-0000-1000-8000-262837236156"
 
 _SUBSCRIBE_TRUE = bytes([0x01, 0x00])
 
+# action, mode, 2 unknown bytes, set temperature, current temperature,
+# keep warm type, keep warm time (only data[7] is read: whether the field
+# continues into data[8] has not been confirmed on a real kettle)
+_STATUS_FORMAT = struct.Struct('BBxxBBBB')
+
 MI_ACTION = "action"
 MI_MODE = "mode"
 MI_SET_TEMPERATURE = "set temperature"
@@ -53,6 +66,37 @@ MI_KW_TYPE_MAP = {
 
 _LOGGER = logging.getLogger(__name__)
 
+# numba (if installed) compiles the RC4 loops; otherwise the pure-Python
+# code is used (a numpy-only XOR measured slower for messages this short)
+_LOGGER.debug("Using %s RC4 implementation", "numba" if _USE_NUMBA else "pure-Python")
+
+# Per-thread 256-byte RC4 state reused by MiKettle.cipher()
+_cipher_scratch = local()
+
+if _USE_NUMBA:
+    @njit(cache=True, boundscheck=False)
+    def _ksa_nb(key, perm):
+        for i in range(256):
+            perm[i] = i
+        keyLen = len(key)
+        j = np.uint8(0)
+        for i in range(256):
+            j = np.uint8(j + perm[i] + key[i % keyLen])
+            perm[i], perm[j] = perm[j], perm[i]
+
+    @njit(cache=True, boundscheck=False)
+    def _prga_nb(inp, perm):
+        index1 = np.uint8(0)
+        index2 = np.uint8(0)
+        output = np.empty(len(inp), dtype=np.uint8)
+        for i in range(len(inp)):
+            index1 = np.uint8(index1 + 1)
+            index2 = np.uint8(index2 + perm[index1])
+            perm[index1], perm[index2] = perm[index2], perm[index1]
+            idx = np.uint8(perm[index1] + perm[index2])
+            output[i] = inp[i] ^ perm[idx]
+        return output
+
 
 class MiKettle(object):
     """"
@@ -68,23 +112,43 @@ class MiKettle(object):
         self._mac = mac
         self._reversed_mac = MiKettle.reverseMac(mac)
         self._cache = None
-        self._cache_timeout = timedelta(seconds=cache_timeout)
+        self._cache_version = 0
+        self._cache_timeout = float(cache_timeout)
         self._last_read = None
         self._ekey = None
+        self._perm_ekey = None
         self._challenging = False
         self._confirming = False
         self._connected = False
+        self._auth_desc = None
+        self._ctrl_desc = None
         self._authed = False
         self.retries = retries
         self.ble_timeout = 10
         self.lock = Lock()
+        self._refreshed = Condition(self.lock)
+        self._refreshing = False
+        self._refresh_generation = 0
+        self._last_refresh_ok = False
         self._product_id = product_id
         self._token = token
+        # The pairing keys only depend on the MAC and product id, so compute
+        # and expand them once instead of on every pairing notification
+        self._mix_a = MiKettle.mixA(self._reversed_mac, self._product_id)
+        self._mix_b = MiKettle.mixB(self._reversed_mac, self._product_id)
+        self._perm_mix_a = MiKettle._cipherInit(self._mix_a)
+        self._perm_mix_b = MiKettle._cipherInit(self._mix_b)
 
     def connect(self):
         if not self._connected:
             self._p = Peripheral(self._mac)
             self._p.setDelegate(self)
+            # Discover the descriptors once per connection, not on every
+            # auth / subscribe: each lookup is a GATT round-trip
+            auth_service = self._p.getServiceByUUID(_UUID_SERVICE_KETTLE)
+            self._auth_desc = auth_service.getDescriptors()[1]
+            control_service = self._p.getServiceByUUID(_UUID_SERVICE_KETTLE_DATA)
+            self._ctrl_desc = control_service.getDescriptors()[3]
             self._connected = True
 
     def name(self):
@@ -96,7 +160,7 @@ class MiKettle(object):
         if not name:
             raise Exception("Could not read NAME using handle %s"
                             " from Mi Kettle %s" % (_HANDLE_READ_NAME, self._mac))
-        return ''.join(chr(n) for n in name)
+        return bytes(name).decode('ascii', errors='ignore').rstrip('\x00')
 
     def firmware_version(self):
         """Return the firmware version."""
@@ -107,7 +171,7 @@ class MiKettle(object):
         if not firmware_version:
             raise Exception("Could not read FIRMWARE_VERSION using handle %s"
                             " from Mi Kettle %s" % (_HANDLE_READ_FIRMWARE_VERSION, self._mac))
-        return ''.join(chr(n) for n in firmware_version)
+        return bytes(firmware_version).decode('ascii', errors='ignore').rstrip('\x00')
 
     def parameter_value(self, parameter, read_cached=True):
         """Return a value of one of the monitored paramaters.
@@ -116,25 +180,50 @@ class MiKettle(object):
         expired.
         This behaviour can be overwritten by the "read_cached" parameter.
         """
-        # Use the lock to make sure the cache isn't updated multiple times
+        # Use the lock to make sure the cache isn't updated multiple times,
+        # but don't hold it during the BLE I/O itself: only one caller
+        # refreshes, the others wait for it to publish the new data
+        refresh = False
+        fresh = True
         with self.lock:
-            if (read_cached is False) or \
+            if self._refreshing:
+                # Wait for the running refresh and use the outcome it publishes
+                generation = self._refresh_generation
+                while self._refresh_generation == generation:
+                    self._refreshed.wait()
+                fresh = self._last_refresh_ok
+            elif (read_cached is False) or \
                     (self._last_read is None) or \
-                    (datetime.now() - self._cache_timeout > self._last_read):
-                self.fill_cache()
+                    (time.monotonic() - self._last_read > self._cache_timeout):
+                self._refreshing = True
+                refresh = True
             else:
-                _LOGGER.debug("Using cache (%s < %s)",
-                              datetime.now() - self._last_read,
+                _LOGGER.debug("Using cache (%.1fs < %.1fs)",
+                              time.monotonic() - self._last_read,
                               self._cache_timeout)
 
-        if self.cache_available():
-            return self._cache[parameter]
-        else:
+        if refresh:
+            fresh = False
+            try:
+                fresh = self.fill_cache()
+            finally:
+                with self.lock:
+                    self._last_refresh_ok = fresh
+                    self._refresh_generation += 1
+                    self._refreshing = False
+                    self._refreshed.notify_all()
+
+        cache = self._cache
+        if not fresh or cache is None:
             raise Exception("Could not read data from MiKettle %s" % self._mac)
+        return cache[parameter]
 
-    def fill_cache(self):
-        """Fill the cache with new data from the sensor."""
+    def fill_cache(self) -> bool:
+        """Fill the cache with new data from the sensor.
+        Return True if the sensor delivered new data.
+        """
         _LOGGER.debug('Filling cache with new sensor data.')
+        version = self._cache_version
         try:
             _LOGGER.debug('Connect')
             self.connect()
@@ -147,11 +236,21 @@ class MiKettle(object):
             # If a sensor doesn't work, wait 5 minutes before retrying
         except Exception as error:
             _LOGGER.debug('Error %s', error)
-            self._last_read = datetime.now() - self._cache_timeout + \
-                timedelta(seconds=300)
+            self._backoff()
             self._connected = False
+            self._auth_desc = None
+            self._ctrl_desc = None
             self._authed = False
-            return
+            return False
+
+        return self._cache_version != version
+
+    def _backoff(self):
+        """Drop the cached data and don't retry for 5 minutes.
+        Reads during the backoff then fail instead of returning stale data.
+        """
+        self._cache = None
+        self._last_read = time.monotonic() - self._cache_timeout + 300.0
 
     def clear_cache(self):
         """Manually force the cache to be cleared."""
@@ -164,29 +263,20 @@ class MiKettle(object):
 
     def _parse_data(self, data):
         """Parses the byte array returned by the sensor."""
-        res = dict()
-        res[MI_ACTION] = MI_ACTION_MAP[int(data[0])]
-        res[MI_MODE] = MI_MODE_MAP[int(data[1])]
-        res[MI_SET_TEMPERATURE] = int(data[4])
-        res[MI_CURRENT_TEMPERATURE] = int(data[5])
-        res[MI_KW_TYPE] = MI_KW_TYPE_MAP[int(data[6])]
-        res[MI_KW_TIME] = MiKettle.bytes_to_int(data[7:8])
-        return res
-
-    @staticmethod
-    def bytes_to_int(bytes):
-        result = 0
-        for b in bytes:
-            result = result * 256 + int(b)
-
-        return result
+        action, mode, set_temp, cur_temp, kw_type, kw_time = \
+            _STATUS_FORMAT.unpack_from(data)
+        return {
+            MI_ACTION: MI_ACTION_MAP[action],
+            MI_MODE: MI_MODE_MAP[mode],
+            MI_SET_TEMPERATURE: set_temp,
+            MI_CURRENT_TEMPERATURE: cur_temp,
+            MI_KW_TYPE: MI_KW_TYPE_MAP[kw_type],
+            MI_KW_TIME: kw_time,
+        }
 
     def auth(self):
         if not self._authed:
-            auth_service = self._p.getServiceByUUID(_UUID_SERVICE_KETTLE)
-            auth_descriptors = auth_service.getDescriptors()
-
-            auth_descriptors[1].write(_SUBSCRIBE_TRUE, "true")
+            self._auth_desc.write(_SUBSCRIBE_TRUE, "true")
 
             self._challenging = True
             self._p.writeCharacteristic(_HANDLE_AUTH_INIT, _SESSION_START, "true")
@@ -194,7 +284,7 @@ class MiKettle(object):
 
             self._confirming = True
             self._p.writeCharacteristic(_HANDLE_AUTH,
-                                        MiKettle.challengeResponse(self._ekey),
+                                        MiKettle.challengeResponse(self._ekey, self._perm_ekey),
                                         "true")
             self._p.waitForNotifications(10.0)
 
@@ -202,18 +292,12 @@ class MiKettle(object):
             self._authed = True
 
     def subscribeToData(self):
-        controlService = self._p.getServiceByUUID(_UUID_SERVICE_KETTLE_DATA)
-        controlDescriptors = controlService.getDescriptors()
-        controlDescriptors[3].write(_SUBSCRIBE_TRUE, "true")
+        self._ctrl_desc.write(_SUBSCRIBE_TRUE, "true")
 
     @staticmethod
     def reverseMac(mac) -> bytes:
-        parts = mac.split(":")
-        reversedMac = bytearray()
-        leng = len(parts)
-        for i in range(1, leng + 1):
-            reversedMac.extend(bytearray.fromhex(parts[leng - i]))
-        return reversedMac
+        """Return the MAC address bytes in reverse order, as immutable bytes."""
+        return bytes.fromhex(mac.replace(':', ''))[::-1]
 
     @staticmethod
     def mixA(mac, productID) -> bytes:
@@ -224,40 +308,59 @@ class MiKettle(object):
         return bytes([mac[0], mac[2], mac[5], ((productID >> 8) & 0xff), mac[4], mac[0], mac[5], (productID & 0xff)])
 
     @staticmethod
-    def _cipherInit(key) -> bytes:
-        perm = bytearray()
-        for i in range(0, 256):
-            perm.extend(bytes([i & 0xff]))
+    def _cipherInit(key, out=None) -> bytearray:
+        """Return the RC4 permutation for key.
+        If out is given, it is filled in place and returned; otherwise a new
+        bytearray is allocated. The result is mutable: _cipherCrypt swaps
+        its entries.
+        """
+        perm = bytearray(256) if out is None else out
+        if _USE_NUMBA:
+            # bytes() makes key/input read-only views whether the caller
+            # passed bytes or bytearray, so only the warmed-up signature of
+            # each kernel is ever compiled
+            _ksa_nb(np.frombuffer(bytes(key), dtype=np.uint8),
+                    np.frombuffer(perm, dtype=np.uint8))
+            return perm
+        perm[:] = range(256)
         keyLen = len(key)
         j = 0
         for i in range(0, 256):
-            j += perm[i] + key[i % keyLen]
-            j = j & 0xff
+            j = (j + perm[i] + key[i % keyLen]) & 0xff
             perm[i], perm[j] = perm[j], perm[i]
         return perm
 
     @staticmethod
     def _cipherCrypt(input, perm) -> bytes:
+        if _USE_NUMBA:
+            return bytes(_prga_nb(np.frombuffer(bytes(input), dtype=np.uint8),
+                                  np.frombuffer(perm, dtype=np.uint8)))
         index1 = 0
         index2 = 0
-        output = bytearray()
-        for i in range(0, len(input)):
-            index1 = index1 + 1
-            index1 = index1 & 0xff
-            index2 += perm[index1]
-            index2 = index2 & 0xff
+        length = len(input)
+        keystream = bytearray(length)
+        for i in range(0, length):
+            index1 = (index1 + 1) & 0xff
+            index2 = (index2 + perm[index1]) & 0xff
             perm[index1], perm[index2] = perm[index2], perm[index1]
-            idx = perm[index1] + perm[index2]
-            idx = idx & 0xff
-            outputByte = input[i] ^ perm[idx]
-            output.extend(bytes([outputByte & 0xff]))
+            keystream[i] = perm[(perm[index1] + perm[index2]) & 0xff]
 
-        return output
+        # XOR the whole message at once as a single (short) integer
+        return (int.from_bytes(input, 'big') ^
+                int.from_bytes(keystream, 'big')).to_bytes(length, 'big')
 
     @staticmethod
-    def cipher(key, input) -> bytes:
-        perm = MiKettle._cipherInit(key)
-        return MiKettle._cipherCrypt(input, perm)
+    def cipher(key, input, perm=None) -> bytes:
+        # perm is an optional precomputed _cipherInit(key); the PRGA mutates
+        # its state, so run it on this thread's scratch buffer instead
+        scratch = getattr(_cipher_scratch, 'perm', None)
+        if scratch is None:
+            scratch = _cipher_scratch.perm = bytearray(256)
+        if perm is None:
+            MiKettle._cipherInit(key, scratch)
+        else:
+            scratch[:] = perm
+        return MiKettle._cipherCrypt(input, scratch)
 
     @staticmethod
     def generateEkey(token, challenge) -> bytes:
@@ -268,50 +371,52 @@ class MiKettle(object):
         return ekey
 
     @staticmethod
-    def challengeResponse(ekey) -> bytes:
-        response = MiKettle.cipher(ekey, _SESSION_END)
-        print("Response: ", response.hex())
-        return response
+    def challengeResponse(ekey, perm=None) -> bytes:
+        return MiKettle.cipher(ekey, _SESSION_END, perm)
 
     @staticmethod
-    def checkConfirmation(ekey, confirmation) -> bool:
-        actual = MiKettle.cipher(ekey, confirmation)[0:4]
-        print("Expected: ", _CONFIRMATION.hex(), ", Actual: ", actual.hex())
-        return actual == _CONFIRMATION
+    def checkConfirmation(ekey, confirmation, perm=None) -> bool:
+        return MiKettle.cipher(ekey, confirmation, perm)[0:4] == _CONFIRMATION
 
     def checkPairing(self, data) -> bool:
-        return MiKettle.cipher(MiKettle.mixB(self._reversed_mac, self._product_id),
-                               MiKettle.cipher(MiKettle.mixA(self._reversed_mac,
-                                                             self._product_id),
-                                               data)) != self._token
+        return MiKettle.cipher(self._mix_b,
+                               MiKettle.cipher(self._mix_a, data, self._perm_mix_a),
+                               self._perm_mix_b) == self._token
 
     def handleNotification(self, cHandle, data):
         if cHandle == _HANDLE_AUTH:
             if self._challenging:
                 self._challenging = False
                 self._ekey = MiKettle.generateEkey(self._token, data)
+                self._perm_ekey = MiKettle._cipherInit(self._ekey)
             elif self._confirming:
                 self._confirming = False
-                if not MiKettle.checkConfirmation(self._ekey, data):
+                if not MiKettle.checkConfirmation(self._ekey, data, self._perm_ekey):
                     raise Exception("Unexpected response during confirmation.")
-            elif not checkPairing(self, data):
+            elif not self.checkPairing(data):
                 raise Exception("Authentication failed.")
         elif cHandle == _HANDLE_STATUS:
             _LOGGER.debug("Status update:")
             if data is None:
               return
 
-            _LOGGER.debug("Parse data: %s", data)
+            debug = _LOGGER.isEnabledFor(logging.DEBUG)
+            if debug:
+                _LOGGER.debug("Parse data: %s", data)
             self._cache = self._parse_data(data)
-            _LOGGER.debug("data parsed %s", self._cache)
+            self._cache_version += 1
+            if debug:
+                _LOGGER.debug("data parsed %s", self._cache)
 
             if self.cache_available():
-                self._last_read = datetime.now()
+                self._last_read = time.monotonic()
             else:
                 # If a sensor doesn't work, wait 5 minutes before retrying
-                self._last_read = datetime.now() - self._cache_timeout + \
-                    timedelta(seconds=300)
+                self._backoff()
         else:
-            _LOGGER.error("Unknown notification from handle: %s with Data: %s", cHandle, data.hex())
+            _LOGGER.error("Unknown notification from handle: %s with Data: %r", cHandle, data)
 
 
+if _USE_NUMBA:
+    # Compile (or load from cache) the RC4 kernels now, not during the first auth
+    MiKettle.cipher(b'\x00', b'\x00')
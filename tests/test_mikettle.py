@@ -0,0 +1,155 @@
+"""Tests for the Mi Kettle protocol helpers."""
+import threading
+
+import pytest
+
+from custom_components.mikettle import mikettle
+from custom_components.mikettle.mikettle import (
+    MiKettle,
+    MI_ACTION,
+    MI_CURRENT_TEMPERATURE,
+    MI_KW_TIME,
+    MI_KW_TYPE,
+    MI_MODE,
+    MI_SET_TEMPERATURE,
+    _HANDLE_AUTH,
+    _HANDLE_STATUS,
+)
+
+# Published RC4 test vectors: key, plaintext, ciphertext
+RC4_VECTORS = [
+    (b"Key", b"Plaintext", bytes.fromhex("bbf316e8d940af0ad3")),
+    (b"Wiki", b"pedia", bytes.fromhex("1021bf0420")),
+    (b"Secret", b"Attack at dawn", bytes.fromhex("45a01f645fc35b383552544b9bf5")),
+]
+
+# Status notifications: keeping warm at 90 (currently 88), keep warm time 30,
+# once as an 8-byte packet and once with a trailing ninth byte
+STATUS_PACKETS = [
+    bytes([0x03, 0x03, 0x00, 0x00, 0x5A, 0x58, 0x00, 0x1E]),
+    bytes([0x03, 0x03, 0x00, 0x00, 0x5A, 0x58, 0x00, 0x1E, 0x00]),
+]
+
+
+@pytest.fixture(params=["python", "numba"])
+def rc4_backend(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(mikettle, "_USE_NUMBA", False)
+    elif not mikettle._USE_NUMBA:
+        pytest.skip("numba is not installed")
+    return request.param
+
+
+@pytest.mark.parametrize("key, plaintext, ciphertext", RC4_VECTORS)
+def test_cipher_known_answer(rc4_backend, key, plaintext, ciphertext):
+    assert bytes(MiKettle.cipher(key, plaintext)) == ciphertext
+    assert bytes(MiKettle.cipher(bytearray(key), bytearray(plaintext))) == ciphertext
+    assert bytes(MiKettle.cipher(key, ciphertext)) == plaintext
+
+
+@pytest.mark.parametrize("key, plaintext, ciphertext", RC4_VECTORS)
+def test_cipher_reuses_precomputed_perm(rc4_backend, key, plaintext, ciphertext):
+    perm = MiKettle._cipherInit(key)
+    expanded = bytes(perm)
+    # The cached permutation must survive being used more than once
+    assert bytes(MiKettle.cipher(key, plaintext, perm)) == ciphertext
+    assert bytes(MiKettle.cipher(key, plaintext, perm)) == ciphertext
+    assert bytes(perm) == expanded
+
+
+def test_cipher_init_fills_buffer_in_place(rc4_backend):
+    out = bytearray(256)
+    assert MiKettle._cipherInit(b"Key", out) is out
+    assert out == MiKettle._cipherInit(b"Key")
+    assert sorted(out) == list(range(256))
+
+
+def test_numba_kernels_compiled_once():
+    if not mikettle._USE_NUMBA:
+        pytest.skip("numba is not installed")
+    MiKettle.cipher(bytearray(b"Key"), bytearray(b"Plaintext"))
+    assert len(mikettle._ksa_nb.signatures) == 1
+    assert len(mikettle._prga_nb.signatures) == 1
+
+
+def _pairing_payload(kettle):
+    """Encrypt the token the way the kettle does for a pairing notification."""
+    return bytes(MiKettle.cipher(kettle._mix_a,
+                                 MiKettle.cipher(kettle._mix_b, kettle._token)))
+
+
+def test_pairing_accepts_matching_payload():
+    kettle = MiKettle("78:11:DC:C2:F1:7F", 131)
+    payload = _pairing_payload(kettle)
+    assert kettle.checkPairing(payload)
+    kettle.handleNotification(_HANDLE_AUTH, payload)
+
+
+def test_pairing_rejects_corrupted_payload():
+    kettle = MiKettle("78:11:DC:C2:F1:7F", 131)
+    payload = bytearray(_pairing_payload(kettle))
+    payload[0] ^= 0xFF
+    assert not kettle.checkPairing(bytes(payload))
+    with pytest.raises(Exception, match="Authentication failed."):
+        kettle.handleNotification(_HANDLE_AUTH, bytes(payload))
+
+
+@pytest.mark.parametrize("data", STATUS_PACKETS)
+def test_parse_data(data):
+    kettle = MiKettle("78:11:DC:C2:F1:7F", 131)
+    assert kettle._parse_data(data) == {
+        MI_ACTION: "keeping warm",
+        MI_MODE: "keep warm",
+        MI_SET_TEMPERATURE: 90,
+        MI_CURRENT_TEMPERATURE: 88,
+        MI_KW_TYPE: "warm up",
+        MI_KW_TIME: 30,
+    }
+
+
+def test_failed_refresh_is_not_served_from_cache(monkeypatch):
+    kettle = MiKettle("78:11:DC:C2:F1:7F", 131)
+    kettle.handleNotification(_HANDLE_STATUS, STATUS_PACKETS[0])
+    assert kettle.parameter_value(MI_ACTION) == "keeping warm"
+
+    def connect():
+        raise OSError("Device disconnected")
+
+    monkeypatch.setattr(kettle, "connect", connect)
+    with pytest.raises(Exception):
+        kettle.parameter_value(MI_ACTION, read_cached=False)
+    # Still within the 5 minute backoff: the old data must not come back
+    with pytest.raises(Exception):
+        kettle.parameter_value(MI_ACTION)
+
+
+def test_waiter_gets_result_of_refresh_in_progress(monkeypatch):
+    kettle = MiKettle("78:11:DC:C2:F1:7F", 131)
+    notified = threading.Event()
+    waiting = threading.Event()
+
+    def fill_cache():
+        # The status notification arrives before waitForNotifications returns
+        version = kettle._cache_version
+        kettle.handleNotification(_HANDLE_STATUS, STATUS_PACKETS[0])
+        notified.set()
+        waiting.wait(5)
+        return kettle._cache_version != version
+
+    wait = kettle._refreshed.wait
+
+    def wait_and_signal(*args):
+        waiting.set()
+        return wait(*args)
+
+    monkeypatch.setattr(kettle, "fill_cache", fill_cache)
+    monkeypatch.setattr(kettle._refreshed, "wait", wait_and_signal)
+
+    results = []
+    refresher = threading.Thread(
+        target=lambda: results.append(kettle.parameter_value(MI_ACTION)))
+    refresher.start()
+    notified.wait(5)
+    assert kettle.parameter_value(MI_ACTION) == "keeping warm"
+    refresher.join(5)
+    assert results == ["keeping warm"]